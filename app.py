@@ -2,16 +2,11 @@ import streamlit as st
 from streamlit_modal import Modal
 import streamlit_authenticator as stauth
 import env as env
-from datetime import datetime
 import time
 
-from mutual_funds import Portfolio
+from mutual_funds import Portfolio, clear_nav_data
 from plots_and_summary import *
 
-import matplotlib
-
-cmap = matplotlib.colormaps["RdYlGn"]
-
 logger = get_simple_logger("app")
 st.set_page_config(
     layout="wide",
@@ -23,14 +18,21 @@ st.set_page_config(
 st.title("Mutual Fund Portfolio Analysis")
 
 
-@st.cache_data
-def create_portfolio(username, date):
+@st.cache_resource(ttl=3600, show_spinner="Loading portfolio...")
+def create_portfolio(username):
+    """The `Portfolio` is shared by reference across reruns and sessions, so it must only be read from."""
     client = get_mongo_client()
     transactions = get_transactions(client, username)
 
     portfolio = Portfolio(transactions=transactions)
     pnl = portfolio.get_pnl_timeseries()
-    return pnl, portfolio
+    return portfolio, pnl
+
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def get_pnl_(username):
+    _, pnl = create_portfolio(username)
+    return pnl
 
 
 @st.cache_data
@@ -38,11 +40,52 @@ def load_config_():
     return load_config()
 
 
-@st.cache_data
+# only the scheme codes are used, so hash those instead of the whole frame
+@st.cache_data(
+    hash_funcs={pd.DataFrame: lambda df: tuple(df["scheme_code"].unique().tolist())}
+)
 def get_all_holdings_(pnl):
     return get_all_holdings(pnl)
 
 
+@st.cache_data(show_spinner=False)
+def create_summary_(pnl, extra_deltas):
+    return create_summary(pnl=pnl, extra_deltas=list(extra_deltas))
+
+
+@st.cache_data(show_spinner=False)
+def create_scheme_level_absolute_pnl_summary_(pnl_all, names_scheme_mapping, num_days):
+    return create_scheme_level_absolute_pnl_summary(
+        pnl_all, names_scheme_mapping, num_days
+    )
+
+
+figure_functions = {
+    func.__name__: func
+    for func in [plot_pnl_and_pnl_percentage, plot_total_investment_and_current_value]
+}
+
+
+# functions can not be hashed by `st.cache_data`, so they are passed by name
+@st.cache_data(
+    show_spinner=False,
+    hash_funcs={pd.DatetimeIndex: lambda dates: dates.asi8.tobytes()},
+)
+def create_figure_(func_name, **kwargs):
+    return figure_functions[func_name](**kwargs)
+
+
+@st.cache_data(show_spinner=False)
+def create_scheme_level_relative_pnl_summary_(
+    pnl_all, names_scheme_mapping, extra_deltas
+):
+    return create_scheme_level_relative_pnl_summary(
+        pnl=pnl_all,
+        extra_deltas=list(extra_deltas),
+        names_scheme_mapping=names_scheme_mapping,
+    )
+
+
 config = load_config_()
 authenticator = stauth.Authenticate(
     config["credentials"],
@@ -60,7 +103,6 @@ if st.session_state["authentication_status"]:
     authenticator.logout(location="sidebar")
     with st.sidebar:
         reset_btn = st.button("Reset Password", key="reset-password")
-    with st.sidebar:
         st.write(f'Welcome *{st.session_state["name"]}*')
 elif st.session_state["authentication_status"] is False:
     reset_btn = False
@@ -74,6 +116,7 @@ def reset_password():
     try:
         if authenticator.reset_password(st.session_state["username"]):
             save_config(config=config)
+            load_config_.clear()
             st.success("Password modified successfully")
     except Exception as e:
         st.error(e)
@@ -88,6 +131,7 @@ def register_new_user():
         ) = authenticator.register_user(pre_authorization=False)
         if email_of_registered_user:
             save_config(config=config)
+            load_config_.clear()
             st.success(f"User {name_of_registered_user} registered successfully")
 
     except Exception as e:
@@ -102,9 +146,6 @@ if reset_password_modal.is_open():
     with reset_password_modal.container():
         st.write("Please enter the details below")
         reset_password()
-        st.cache_data.clear()
-        config = load_config_()
-        time.sleep(2)
 
 # Register new
 if st.session_state["authentication_status"]:
@@ -119,9 +160,17 @@ if register_modal.is_open():
     with register_modal.container():
         st.write("Please enter the details below")
         register_new_user()
-        st.cache_data.clear()
-        config = load_config_()
-        time.sleep(2)
+
+
+def show_figure(fig, uirevision):
+    """Displays a plotly figure. `uirevision` should be unique for each chart so that zoom and pan are kept between reruns."""
+    fig.update_layout(uirevision=uirevision)
+    st.plotly_chart(
+        fig,
+        use_container_width=True,
+        theme=None,
+        config={"staticPlot": False, "responsive": True},
+    )
 
 
 def color_rules(val):
@@ -134,15 +183,33 @@ def color_rules(val):
         return "color: grey"
 
 
-def display_filtered(df, filter):
-    date_columns = df.columns[df.columns.str.contains("date", case=False)]
+def color_columns(col):
+    """Column-wise version of `color_rules` to be used with `Styler.apply`"""
+    if pd.api.types.is_numeric_dtype(col) and not pd.api.types.is_bool_dtype(col):
+        return np.where(col.to_numpy() < 0, "color: #fa7069", "color: #8ced79")
+    if (
+        pd.api.types.is_datetime64_any_dtype(col)
+        or pd.api.types.infer_dtype(col, skipna=False) == "string"
+    ):
+        return np.full(len(col), "color: orange")
+    # mixed columns still need to be checked cell by cell
+    return col.map(color_rules).to_numpy()
+
+
+def partition_columns(columns, filter):
+    """Returns the date columns, the columns matching `filter` and the new names of the selected columns with `filter` removed"""
+    date_columns = [col for col in columns if "date" in col.lower()]
     if filter:
-        columns = df.filter(like=filter).columns
-    else:
-        columns = df.columns
-    df = df[date_columns.tolist() + columns.tolist()]
+        columns = [col for col in columns if filter in col]
+    selected = date_columns + list(columns)
+    renamed = [col.replace(filter, "") for col in selected]
+    return date_columns, selected, renamed
 
-    df.columns = df.columns.str.replace(filter, "", regex=False)
+
+def display_filtered(df, filter):
+    date_columns, selected, renamed = partition_columns(df.columns, filter)
+    df = df[selected]
+    df.columns = renamed
     all_columns = df.columns
     column_config = {
         col: st.column_config.NumberColumn(col, format="%.4f", width=90, help=col)
@@ -152,30 +219,126 @@ def display_filtered(df, filter):
     make_plot = st.checkbox("Plot", key=f"make_plot_{filter}")
     if not make_plot:
         st.dataframe(
-            df.style.map(color_rules),
+            df.style.apply(color_columns),
             column_config=column_config,
         )
         return
-    # st.line_chart(df)
-    from plotly.subplots import make_subplots
-    import plotly.graph_objects as go
+    x = df.index.to_numpy()
+    value_columns = [col for col in all_columns if col not in date_columns]
+    scatter = scatter_trace(len(df) * len(value_columns))
+    # one block conversion instead of one per column
+    ys = df[value_columns].to_numpy(dtype=float)
+    traces = [
+        scatter(x=x, y=ys[:, i], mode="lines", name=col)
+        for i, col in enumerate(value_columns)
+    ]
+    title = "PnL %" if "%" in filter else "PnL"
+    fig = go.Figure(
+        data=traces,
+        layout=dict(
+            title_text=title,
+            xaxis_title=df.index.name,
+            yaxis_title=title,
+        ),
+    )
+    # the scheme level tables only exist for the portfolio, the filter tells them apart
+    show_figure(fig, uirevision=f"Portfolio-{filter}")
+
+
+# built once instead of on every rerun of the tabs
+EXTRA_DELTA_OPTIONS = tuple(range(4, 700, 1))
 
-    fig = make_subplots(rows=1, cols=1, shared_xaxes=True)
 
-    for col in all_columns:
-        if col in date_columns:
-            continue
-        fig.add_trace(
-            go.Scatter(x=df.index, y=df[col], mode="lines", name=col), row=1, col=1
+# each tab is its own fragment, so a widget only reruns the tab it is in
+@st.experimental_fragment
+def summary_fragment(pnl):
+    st.write("Summary")
+    extra_deltas = st.multiselect(
+        "Select Extra Deltas in Days. This will be added to the summary",
+        options=EXTRA_DELTA_OPTIONS,
+        key="summary_tab",
+    )
+    try:
+        summary_df = create_summary_(pnl, tuple(extra_deltas))
+        st.dataframe(summary_df.style.apply(color_columns))
+    except Exception as e:
+        st.error(f"Error in creating summary: {e}")
+
+
+@st.experimental_fragment
+def scheme_level_absolute_summary_fragment(pnl_all, names_scheme_mapping):
+    columns = st.columns([1, 1])
+    with columns[0]:
+        num_days = st.slider(
+            "Number of Days to look back for the scheme level summary",
+            min_value=1,
+            max_value=15,
+            value=3,
+            step=1,
+        )
+    with columns[1]:
+        column_to_view = st.selectbox(
+            "Select the column to view",
+            [
+                "Percentage PnL",
+                "PnL",
+            ],
+            key="scheme_level_absolute_summary",
         )
 
-    filter = "PnL %" if "%" in filter else "PnL"
-    fig.update_layout(
-        title_text=filter,
-        xaxis_title=df.index.name,
-        yaxis_title=filter,
+    pnl_summary_scheme_level = create_scheme_level_absolute_pnl_summary_(
+        pnl_all, names_scheme_mapping, num_days
     )
-    st.plotly_chart(fig)
+    if column_to_view == "PnL":
+        column_to_view = "Pnl_"
+    else:
+        column_to_view = "Pnl%_"
+    display_filtered(pnl_summary_scheme_level, column_to_view)
+
+
+@st.experimental_fragment
+def scheme_level_relative_summary_fragment(pnl_all, names_scheme_mapping):
+    columns = st.columns([1, 1])
+    with columns[0]:
+        extra_deltas = st.multiselect(
+            "Select Extra Deltas in Days. This will be added to the summary",
+            options=EXTRA_DELTA_OPTIONS,
+            key="scheme_level_relative_summary_delta",
+        )
+    with columns[1]:
+        column_to_view = st.selectbox(
+            "Select the column to view",
+            [
+                "Percentage Change in PnL",
+                "Change in PnL",
+            ],
+            key="scheme_level_relative_summary_columns",
+        )
+
+    if column_to_view == "Change in PnL":
+        column_to_view = "change_in_pnl_"
+    else:
+        column_to_view = "change_in_pnl%_"
+
+    summary_df = create_scheme_level_relative_pnl_summary_(
+        pnl_all, names_scheme_mapping, tuple(extra_deltas)
+    )
+    display_filtered(summary_df, column_to_view)
+
+
+@st.experimental_fragment
+def create_figure_element_with_resample(func_to_use, uirevision, **kwargs):
+    resample_frequency = st.selectbox(
+        "Select a Resample Frequency. If None, no resampling will be done.",
+        [None, "W", "M", "Y"],
+        index=0,
+        key=func_to_use.__name__,
+    )
+    fig = create_figure_(
+        func_to_use.__name__, resample_frequency=resample_frequency, **kwargs
+    )
+    with st.container():
+        show_figure(fig, uirevision=uirevision)
 
 
 def plot_all(pnl, holding=None, names_scheme_mapping=None, pnl_all=None):
@@ -213,135 +376,69 @@ def plot_all(pnl, holding=None, names_scheme_mapping=None, pnl_all=None):
     logger.info("Plotting")
 
     with summary_tab:
-        st.write("Summary")
-        extra_deltas = st.multiselect(
-            "Select Extra Deltas in Days. This will be added to the summary",
-            options=list(range(4, 700, 1)),
-            key="summary_tab",
-        )
-        try:
-            summary_df = create_summary(pnl=pnl, extra_deltas=extra_deltas)
-            st.dataframe(summary_df.style.applymap(color_rules))
-        except Exception as e:
-            st.error(f"Error in creating summary: {e}")
+        summary_fragment(pnl)
 
     if scheme_level_absolute_summary_tab is not None:
         with scheme_level_absolute_summary_tab:
-            columns = st.columns([1, 1])
-            with columns[0]:
-                num_days = st.slider(
-                    "Number of Days to look back for the scheme level summary",
-                    min_value=1,
-                    max_value=15,
-                    value=3,
-                    step=1,
-                )
-            with columns[1]:
-                column_to_view = st.selectbox(
-                    "Select the column to view",
-                    [
-                        "Percentage PnL",
-                        "PnL",
-                    ],
-                    key="scheme_level_absolute_summary",
-                )
-
-            pnl_summary_scheme_level = create_scheme_level_absolute_pnl_summary(
-                pnl_all, names_scheme_mapping, num_days
-            )
-            if column_to_view == "PnL":
-                column_to_view = "Pnl_"
-            else:
-                column_to_view = "Pnl%_"
-            pnl_summary_scheme_level = pnl_summary_scheme_level.filter(
-                like=column_to_view
-            )
-            display_filtered(pnl_summary_scheme_level, column_to_view)
+            scheme_level_absolute_summary_fragment(pnl_all, names_scheme_mapping)
 
     if scheme_level_relative_summary_tab is not None:
         with scheme_level_relative_summary_tab:
-            columns = st.columns([1, 1])
-            with columns[0]:
-                extra_deltas = st.multiselect(
-                    "Select Extra Deltas in Days. This will be added to the summary",
-                    options=list(range(4, 700, 1)),
-                    key="scheme_level_relative_summary_delta",
-                )
-            with columns[1]:
-                column_to_view = st.selectbox(
-                    "Select the column to view",
-                    [
-                        "Percentage Change in PnL",
-                        "Change in PnL",
-                    ],
-                    key="scheme_level_relative_summary_columns",
-                )
-
-            if column_to_view == "Change in PnL":
-                column_to_view = "change_in_pnl_"
-            else:
-                column_to_view = "change_in_pnl%_"
-
-            summary_df = create_scheme_level_relative_pnl_summary(
-                pnl=pnl_all,
-                extra_deltas=extra_deltas,
-                names_scheme_mapping=names_scheme_mapping,
-            )
-            display_filtered(summary_df, column_to_view)
-
-    def create_figure_element_with_resample(func_to_use, **kwargs):
-        resample_frequency = st.selectbox(
-            "Select a Resample Frequency. If None, no resampling will be done.",
-            [None, "W", "M", "Y"],
-            index=0,
-            key=func_to_use.__name__,
-        )
-        fig = func_to_use(resample_frequency=resample_frequency, **kwargs)
-        with st.container():
-            st.plotly_chart(fig)
+            scheme_level_relative_summary_fragment(pnl_all, names_scheme_mapping)
 
     if holding is None:
         transaction_dates = portfolio.transaction_dates
+        scheme = "Portfolio"
     else:
         transaction_dates = holding.transaction_dates
+        scheme = holding.scheme_code
 
+    # the zoom of a chart is only kept while the same scheme and plot are shown
     with pnl_tab:
         create_figure_element_with_resample(
-            plot_pnl_and_pnl_percentage, df=pnl, transaction_dates=transaction_dates
+            plot_pnl_and_pnl_percentage,
+            uirevision=f"{scheme}-{plot_pnl_and_pnl_percentage.__name__}",
+            df=pnl,
+            transaction_dates=transaction_dates,
         )
 
     with total_investment_tab:
         create_figure_element_with_resample(
             plot_total_investment_and_current_value,
+            uirevision=f"{scheme}-{plot_total_investment_and_current_value.__name__}",
             df=pnl,
             transaction_dates=transaction_dates,
         )
 
 
+def refresh_data(username, scheme_codes):
+    """Drops the cached portfolio and pnl of `username` and the nav data of its schemes, the other users keep theirs"""
+    get_pnl_.clear(username)
+    create_portfolio.clear(username)
+    clear_nav_data(scheme_codes)
+
+
 no_transaction = True
+scheme_codes = []
 try:
     if username is None:
         st.stop()
-    date = datetime.today().strftime("%Y-%m-%d")
-    pnl, portfolio = create_portfolio(username, date)
-    pnl_all = portfolio.pnl.copy()
-    pnl = pnl.copy()
+    portfolio, _ = create_portfolio(username)
+    pnl = get_pnl_(username)
+    pnl_all = portfolio.pnl
+    scheme_codes = list(portfolio.holdings_by_code)
     no_transaction = False
 except NoTransactions as e:
     error_text = f"User {username} does not have any transactions. Upload the transaction data using the Update Transactions"
     st.error(error_text)
 
 # add a refresh button
-refresh_btn = st.sidebar.button("Refresh Data", key="refresh_data")
-if refresh_btn and not no_transaction:
-    # create a random date
-    month = np.random.randint(1, 12)
-    day = np.random.randint(1, 28)
-    year = np.random.randint(2010, 2024)
-    date = datetime(year, month, day).strftime("%Y-%m-%d")
-    pnl, portfolio = create_portfolio(username, date)
-    pnl_all = portfolio.pnl.copy()
-    pnl = pnl.copy()
+st.sidebar.button(
+    "Refresh Data",
+    key="refresh_data",
+    on_click=refresh_data,
+    args=(username, scheme_codes),
+)
 
 update_transactions_btn = st.sidebar.button(
     "Update Transactions", key="update_transactions"
@@ -363,6 +460,7 @@ if modal.is_open():
             logger.info("Updating Transactions")
             try:
                 update_transactions(file_picker, username, debug=False)
+                refresh_data(username, scheme_codes)
                 st.success(
                     "Transactions Updated Successfully. Data will be refreshed automatically"
                 )
@@ -380,10 +478,11 @@ container = st.container(border=False)
 with container:
     rows1 = st.columns(1)
     with rows1[0]:
-        overall_pnl = int(pnl.iloc[-1]["pnl"])
-        overall_pnl_percentage = round(pnl.iloc[-1]["pnl_percentage"], 2)
-        total_invested = pnl.iloc[-1]["total_invested"]
-        current_value = pnl.iloc[-1]["current_value"]
+        latest = pnl.iloc[-1]
+        overall_pnl = int(latest["pnl"])
+        overall_pnl_percentage = round(latest["pnl_percentage"], 2)
+        total_invested = latest["total_invested"]
+        current_value = latest["current_value"]
         overall_pnl_color = "#fa7069" if overall_pnl < 0 else "#8ced79"
         overall_pnl_percentage_color = (
             "#fa7069" if overall_pnl_percentage < 0 else "#8ced79"
@@ -391,11 +490,6 @@ with container:
         st.markdown(
             f"""
             <h4 style="color:{overall_pnl_color}">₹{overall_pnl} &nbsp; &nbsp; &nbsp; &nbsp; &nbsp;{overall_pnl_percentage}%</h4>
-            """,
-            unsafe_allow_html=True,
-        )
-        st.markdown(
-            f"""
             <h6 style="color:grey">Total Invested: ₹{int(total_invested)}</h6>
             <h6 style="color:grey"> Current Value: ₹{int(current_value)}</h6>
             """,
@@ -406,7 +500,8 @@ with container:
 names_scheme_mapping, schemes_names_mapping = get_all_holdings_(pnl_all)
 names = list(names_scheme_mapping.values())
 names = ["Portfolio"] + names
-latest_date = pnl["date"].max().strftime("%Y-%m-%d")
+# pnl is grouped by date, so the last row is the latest date
+latest_date = latest["date"].strftime("%Y-%m-%d")
 
 with st.sidebar:
     st.markdown(
@@ -423,10 +518,8 @@ sidebars = st.sidebar.selectbox(
 with st.sidebar:
     if sidebars != "Portfolio":
         scheme_code = schemes_names_mapping[sidebars]
-        pnl_to_use = pnl_all[pnl_all["scheme_code"] == scheme_code]
-        holding = list(
-            filter(lambda x: x.scheme_code == scheme_code, portfolio.holdings)
-        )[0]
+        pnl_to_use = pnl_all.iloc[portfolio.scheme_indices[scheme_code]]
+        holding = portfolio.holdings_by_code[scheme_code]
     else:
         pnl_to_use = pnl
         holding = None
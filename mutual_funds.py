@@ -1,11 +1,18 @@
 import pandas as pd
-from typing import List, Dict, Union
+from typing import List, Dict, Tuple, Union
 from datetime import datetime
+from functools import lru_cache
 import numpy as np
 import requests
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from heapq import merge
+from itertools import compress, groupby
+from operator import attrgetter
 
 
+# loggers are created for every transaction, so the setup is only done once per name
+@lru_cache(maxsize=None)
 def get_simple_logger(name, level="info"):
     """Creates a simple loger that outputs to stdout"""
     level_to_int_map = {
@@ -32,6 +39,41 @@ def get_simple_logger(name, level="info"):
     return logger
 
 
+# shared by all the nav requests so that the connection to the api is reused
+_session = requests.Session()
+
+# the latest nav data of each scheme along with the hour it was fetched in
+_nav_data: Dict[int, Tuple[str, List[Dict]]] = {}
+
+
+def fetch_nav_data(scheme_code: int) -> List[Dict]:
+    """Fetches the nav data of a scheme from the [mfapi](https://api.mfapi.in). Navs are published once a day, so only the latest response of each scheme is kept and it is refetched once the hour changes. `Portfolio.get_pnl_timeseries` calls it once per distinct scheme."""
+    hour = datetime.now().strftime("%Y-%m-%d %H")
+    cached = _nav_data.get(scheme_code)
+    if cached is not None and cached[0] == hour:
+        return cached[1]
+    response = _session.get(f"https://api.mfapi.in/mf/{scheme_code}")
+    nav_data = response.json()["data"]
+    _nav_data[scheme_code] = (hour, nav_data)
+    return nav_data
+
+
+def clear_nav_data(scheme_codes: List[int] = None):
+    """Forces a refetch of the nav data of `scheme_codes`, or of every scheme if it is None"""
+    if scheme_codes is None:
+        _nav_data.clear()
+        return
+    for scheme_code in scheme_codes:
+        _nav_data.pop(scheme_code, None)
+
+
+@lru_cache(maxsize=4096)
+def _parse_date(date: str):
+    """Parses a `%Y-%m-%d` date and returns it along with its normalized string. Cached as the same dates repeat across transactions and `strptime` is slow."""
+    date_ = datetime.strptime(date, "%Y-%m-%d")
+    return date_, date_.strftime("%Y-%m-%d")
+
+
 class Transaction:
     """A transaction is a single transaction in a mutual fund. It can be a purchase or a sell transaction.
 
@@ -47,6 +89,16 @@ class Transaction:
         The type of transaction. Can be either purchase or sell. The base class does not have a transaction type. The subclasses `Purchase` and `Sell` have the transaction type.
     """
 
+    # a history can hold many transactions, slots keep each of them small
+    __slots__ = (
+        "date_",
+        "date",
+        "units",
+        "average_nav",
+        "transaction_type",
+        "logger",
+    )
+
     def __init__(
         self,
         date: str,
@@ -55,8 +107,7 @@ class Transaction:
         logger: Union[str, datetime] = None,
     ) -> float:
 
-        self.date_ = datetime.strptime(date, "%Y-%m-%d")
-        self.date = self.date_.strftime("%Y-%m-%d")
+        self.date_, self.date = _parse_date(date)
         self.units = units
         self.average_nav = average_nav
         self.transaction_type = None
@@ -79,44 +130,35 @@ class Transaction:
             return val / self.average_nav * 100
         return val
 
+    # read for every transaction when the arrays are built, so kept to one comparison
     @property
     def nav_with_sign(self) -> float:
-        if self.transaction_type is None:
-            return self.average_nav
-
-        if self.transaction_type == "purchase":
-            self.logger.debug(f"Purchase nav {self.average_nav}")
-            return self.average_nav
-        self.logger.debug(f"Sell nav {self.average_nav}")
-        return -self.average_nav
+        return (
+            -self.average_nav if self.transaction_type == "sell" else self.average_nav
+        )
 
     @property
     def units_with_sign(self) -> float:
-        if self.transaction_type is None:
-            return self.units
-
-        if self.transaction_type == "purchase":
-            self.logger.debug(f"Purchase units {self.units}")
-            return self.units
-        self.logger.debug(f"Sell units {self.units}")
-        return -self.units
+        return -self.units if self.transaction_type == "sell" else self.units
 
 
 class Purchase(Transaction):
     """A purchase transaction in a mutual fund. Inherits from `Transaction` class."""
 
+    __slots__ = ()
+
     def __init__(self, date: str, units: float, average_nav: float, logger=None):
-        super().__init__(date, units, average_nav)
-        self.logger = logger or get_simple_logger(self.__class__.__name__)
+        super().__init__(date, units, average_nav, logger)
         self.transaction_type = "purchase"
 
 
 class Sell(Transaction):
     """A sell transaction in a mutual fund. Inherits from `Transaction` class."""
 
+    __slots__ = ()
+
     def __init__(self, date: str, units: float, average_nav: float, logger=None):
-        super().__init__(date, units, average_nav)
-        self.logger = logger or get_simple_logger(self.__class__.__name__)
+        super().__init__(date, units, average_nav, logger)
         self.transaction_type = "sell"
 
 
@@ -124,6 +166,8 @@ class TransactionHistory:
     def __init__(self, logger: Union[str, datetime] = None) -> float:
         self.transaction_history_og: List[Transaction] = []
         self.max_date = None
+        # filtered transactions and arrays per `max_date`, cleared on any change
+        self._cache = {}
         self.logger = logger or get_simple_logger(self.__class__.__name__)
 
     def __str__(self) -> str:
@@ -140,7 +184,7 @@ class TransactionHistory:
         return self.transaction_history[key]
 
     def __add__(self, other):
-        new = self.__class__()
+        new = self.__class__(logger=self.logger)
         new.transaction_history_og = (
             self.transaction_history_og + other.transaction_history_og
         )
@@ -160,7 +204,8 @@ class TransactionHistory:
             raise ValueError(
                 "Invalid transaction type. Must be either purchase or sell."
             )
-        self.transaction_history.append(transaction)
+        self.transaction_history_og.append(transaction)
+        self._cache.clear()
 
     @property
     def transaction_history(self) -> List[Transaction]:
@@ -169,52 +214,98 @@ class TransactionHistory:
             return self.transaction_history_og
 
         if isinstance(self.max_date, str):
-            self.max_date = datetime.strptime(self.max_date, "%Y-%m-%d")
+            # cached, the same `max_date` string is usually passed again and again
+            self.max_date, _ = _parse_date(self.max_date)
+
+        key = ("transactions", self.max_date)
+        if key not in self._cache:
+            # compare all the dates at once and keep the matching transactions in order
+            mask = self.date_array <= np.datetime64(self.max_date)
+            t = list(compress(self.transaction_history_og, mask))
+            self.logger.debug(
+                f"{len(t)} transactions filtered for date: {self.max_date}"
+            )
+            self._cache[key] = t
+        return self._cache[key]
+
+    def _array(self, name: str, getter) -> np.ndarray:
+        """Builds the array of `getter` applied to the filtered transactions once per `max_date`. The array is read only as it is shared between calls."""
+        transactions = self.transaction_history
+        key = (name, self.max_date)
+        if key not in self._cache:
+            array = np.fromiter(
+                (getter(x) for x in transactions),
+                dtype=np.float64,
+                count=len(transactions),
+            )
+            array.flags.writeable = False
+            self._cache[key] = array
+        return self._cache[key]
 
-        t = [x for x in self.transaction_history_og if x.date_ <= self.max_date]
-        self.logger.debug(f"{len(t)} transactions filtered for date: {self.max_date}")
-        return t
+    @property
+    def date_array(self) -> np.ndarray:
+        """Get the dates of all the transactions, ignoring `max_date`, as a numpy array."""
+        key = ("date_array",)
+        if key not in self._cache:
+            self._cache[key] = np.array(
+                [x.date_ for x in self.transaction_history_og], dtype="datetime64[us]"
+            )
+        return self._cache[key]
+
+    @property
+    def sorted_dates(self) -> List[datetime]:
+        """Get the dates of all the transactions, ignoring `max_date`, in ascending order."""
+        key = ("sorted_dates",)
+        if key not in self._cache:
+            self._cache[key] = sorted(x.date_ for x in self.transaction_history_og)
+        return self._cache[key]
 
     @property
     def unit_array(self) -> np.ndarray:
         """Get the units of all transactions in the transaction history as a numpy array."""
-        units_list = [x.units for x in self.transaction_history]
-        return np.array(units_list)
+        return self._array("units", lambda x: x.units)
 
     @property
     def units_array_with_sign(self) -> np.ndarray:
         """Get the units of all transactions in the transaction history as a numpy array with sign. Sold transactions have negative units."""
-        units_list = [x.units_with_sign for x in self.transaction_history]
-        return np.array(units_list)
+        return self._array("units_with_sign", lambda x: x.units_with_sign)
 
     @property
     def nav_array(self) -> np.ndarray:
         """Get the nav of all transactions in the transaction history as a numpy array."""
-        nav_list = [x.nav for x in self.transaction_history]
-        return np.array(nav_list)
+        return self._array("nav", lambda x: x.nav)
 
     @property
     def nav_array_with_sign(self) -> np.ndarray:
         """Get the nav of all transactions in the transaction history as a numpy array with sign. Sold transactions have negative nav."""
-        nav_list = [x.nav_with_sign for x in self.transaction_history]
-        return np.array(nav_list)
+        return self._array("nav_with_sign", lambda x: x.nav_with_sign)
+
+    def _aggregate(self, max_date: Union[str, datetime] = None):
+        """Computes the sums all the metrics are derived from in one go: the invested amount (units times signed nav), the total signed units and the sum of the signed navs. The result is cached per `max_date`."""
+        self.max_date = max_date
+        self.transaction_history  # normalizes `max_date`
+        key = ("aggregate", self.max_date)
+        if key not in self._cache:
+            nav = self.nav_array_with_sign  # sold transactions have negative nav
+            self._cache[key] = (
+                np.dot(self.unit_array, nav),
+                np.sum(self.units_array_with_sign),
+                np.sum(nav),
+            )
+        return self._cache[key]
 
     def total_units(self, max_date: Union[str, datetime] = None) -> float:
         """Calculate the total units in the transaction history. If max_date is provided, the transactions after the max_date are not considered."""
-        self.max_date = max_date
-        return np.sum(self.units_array_with_sign)
+        _, units_sum, _ = self._aggregate(max_date)
+        return units_sum
 
     def average_nav(self, max_date: Union[str, datetime] = None) -> float:
         """Calculate the average nav of the transaction history. If max_date is provided, the transactions after the max_date are not considered."""
-        self.max_date = max_date
-        units = self.unit_array
-        units_sign = self.units_array_with_sign
-        nav = self.nav_array_with_sign  # sold transactions have negative nav
-        units_sum = np.sum(units_sign)  # remove the sold units
+        invested, units_sum, _ = self._aggregate(max_date)  # sold units are removed
         if units_sum == 0:
             self.logger.info("No units in the transaction history. Returning 0.0")
             return 0
-        return np.sum(units * nav) / units_sum
+        return invested / units_sum
 
     def transactions_pnl(
         self,
@@ -223,9 +314,8 @@ class TransactionHistory:
         max_date: Union[str, datetime] = None,
     ):
         """Calculate the total pnl of the transaction history. If max_date is provided, the transactions after the max_date are not considered. If percentage is True, returns the pnl as a percentage of the invested amount."""
-        self.max_date = max_date
-        invested = np.sum(self.unit_array * self.nav_array_with_sign)
-        current = np.sum(self.units_array_with_sign) * current_nav
+        invested, units_sum, _ = self._aggregate(max_date)
+        current = units_sum * current_nav
         pnl = current - invested
         if percentage:
             return pnl / invested * 100
@@ -233,20 +323,21 @@ class TransactionHistory:
 
     def net_transaction_value(self, max_date: Union[str, datetime] = None) -> float:
         """Calculate the total invested amount in the transaction history. If max_date is provided, the transactions after the max_date are not considered."""
-        self.max_date = max_date
-        if self.nav_array_with_sign.sum() == 0:
+        invested, _, nav_sum = self._aggregate(max_date)
+        if nav_sum == 0:
             self.logger.info(
                 "No transactions in the transaction history. Returning 0 for invested amount."
             )
             return 0
 
-        return np.sum(self.unit_array * self.nav_array_with_sign)
+        return invested
 
     def sort_transactions(self, reverse: bool = True):
         """Sort the transactions in the transaction history based on the date. If reverse is True, sorts in descending order."""
         self.transaction_history_og = sorted(
-            self.transaction_history_og, key=lambda x: x.date_, reverse=reverse
+            self.transaction_history_og, key=attrgetter("date_"), reverse=reverse
         )
+        self._cache.clear()
 
     def create_transactions_from_dict(self, transactions: List[Dict]):
         """Create transactions from a list of dictionaries containing transaction details. Assumes that the dictionary contains keys `date`, `units`, `average_nav` and `transaction_type`."""
@@ -430,23 +521,37 @@ class Holding:
             A dataframe with date, total invested amount, current value, pnl and pnl percentage.
         """
         if nav_data is None:
-            code = self.scheme_code
-            url = f"https://api.mfapi.in/mf/{code}"
-            response = requests.get(url)
-            nav_data = response.json()["data"]
+            nav_data = fetch_nav_data(self.scheme_code)
             self.logger.info(f"Nav data fetched for scheme code {self.scheme_code}")
 
         nav_df = pd.DataFrame(nav_data)
         nav_df["date"] = pd.to_datetime(nav_df["date"], format="%d-%m-%Y")
-        nav_df.sort_values("date", inplace=True)
+        # the api returns the newest nav first, reversing is enough to sort it then
+        if nav_df["date"].is_monotonic_decreasing:
+            nav_df = nav_df.iloc[::-1]
+        elif not nav_df["date"].is_monotonic_increasing:
+            nav_df = nav_df.sort_values("date")
         nav_df["nav"] = pd.to_numeric(nav_df["nav"])
         nav_df = nav_df[["date", "nav"]]
 
-        transactions = self.all_transactions.transaction_history
-        transaction_dates = [x.date_ for x in transactions]
-        # transaction dates will be used to change the total units
-        total_units = [self.get_total_units(x) for x in transaction_dates]
-        transaction_values = [self.invested_amount(t) for t in transaction_dates]
+        history = self.all_transactions
+        transactions = history.transaction_history
+        transaction_dates = np.array(
+            [x.date_ for x in transactions], dtype="datetime64[ns]"
+        )
+        # running totals over the transactions sorted by date give the total units and
+        # invested amount as of each transaction date in a single pass
+        order = np.argsort(transaction_dates, kind="stable")
+        transaction_dates = transaction_dates[order]
+        units = history.unit_array[order]
+        units_sign = history.units_array_with_sign[order]
+        nav_sign = history.nav_array_with_sign[order]
+        # transactions on the same date are all counted as of that date
+        last = np.searchsorted(transaction_dates, transaction_dates, side="right") - 1
+        total_units = np.cumsum(units_sign)[last]
+        transaction_values = np.cumsum(units * nav_sign)[last]
+        # same as `net_transaction_value`, which returns 0 when the navs sum to 0
+        transaction_values[np.cumsum(nav_sign)[last] == 0] = 0
         transaction_df = pd.DataFrame(
             {
                 "date": transaction_dates,
@@ -454,28 +559,29 @@ class Holding:
                 "total_invested": transaction_values,
             }
         )
-        transaction_df["date"] = pd.to_datetime(transaction_df["date"])
-        transaction_df.sort_values("date", inplace=True)
 
         merged = pd.merge_asof(nav_df, transaction_df, on="date")
-        merged = merged[merged["total_units"].notna()]
-        merged["total_invested"] = merged["total_invested"].clip(lower=0)
-        merged = merged.query(
-            "total_invested	>0"
-        )  # remove rows with negative invested amount
+        # drop the dates before the first transaction and the ones with nothing (or a
+        # negative amount) invested in one pass
+        invested = merged["total_units"].notna() & (merged["total_invested"] > 0)
+        merged = merged[invested].copy()
         merged["current_value"] = merged["total_units"] * merged["nav"]
         merged["pnl"] = merged["current_value"] - merged["total_invested"]
-        merged["pnl_percentage"] = merged["pnl"] / merged["total_invested"] * 100
-        merged["pnl_percentage"].fillna(0, inplace=True)
+        merged["pnl_percentage"] = (
+            merged["pnl"] / merged["total_invested"] * 100
+        ).fillna(0)
         return merged
 
     @property
     def transaction_dates(self):
-        purchase_dates = [x.date_ for x in self.purchase_history]
-        sell_dates = [x.date_ for x in self.sell_history]
+        """Get the transaction dates of the `Holding`. Returns a dictionary with keys `purchase_dates` and `sell_dates` holding a `pd.DatetimeIndex` each."""
         return {
-            "purchase_dates": purchase_dates,
-            "sell_dates": sell_dates,
+            "purchase_dates": pd.DatetimeIndex(
+                self.purchase_history.date_array.astype("datetime64[ns]")
+            ),
+            "sell_dates": pd.DatetimeIndex(
+                self.sell_history.date_array.astype("datetime64[ns]")
+            ),
         }
 
 
@@ -486,6 +592,10 @@ class Portfolio:
     ----------
     holdings: List[Holding]
         A list of holding objects
+    holdings_by_code: Dict[int, Holding]
+        The holding objects keyed by their scheme code
+    scheme_indices: Dict[int, np.ndarray]
+        The positions of the rows of each scheme code in `pnl`. Set by `get_pnl_timeseries`.
 
     Methods
     -------
@@ -508,6 +618,7 @@ class Portfolio:
         logger: logging.Logger = None,
     ):
         self.holdings = holdings or []
+        self.holdings_by_code = {x.scheme_code: x for x in self.holdings}
         if transactions:
             self.create_holdings(transactions)
         self.logger = logger or get_simple_logger(self.__class__.__name__)
@@ -529,6 +640,7 @@ class Portfolio:
         for transaction in transactions:
             holding = Holding(transaction_dict=transaction)
             self.holdings.append(holding)
+            self.holdings_by_code[holding.scheme_code] = holding
 
     def get_invested_amount(self, max_date: Union[str, datetime] = None) -> float:
         """Calculate the total invested amount in the entire `Portfolio`. If max_date is provided, the transactions after the max_date are not considered."""
@@ -556,7 +668,8 @@ class Portfolio:
 
     def filter_for_wrong_holdings(self, pnl):
         """Filter the pnl dataframe for wrong holdings. A wrong holding is a holding where the number of holdings changes by more than 50% in a single day even though there are no sell transactions. The root cause of this is not yet known, this function is just a workaround to remove such rows."""
-        pnl["num_holdings"] = pnl["scheme_code"].apply(lambda x: len(eval(x)))
+        # scheme_code holds the list of scheme codes as a string, e.g. "[119091, 120821]"
+        pnl["num_holdings"] = pnl["scheme_code"].str.count(",") + 1
         to_drop = pnl[-pnl["num_holdings"].diff(1) > 0.5 * pnl["num_holdings"]]
         self.logger.info(f"Found {len(to_drop)} rows with potential wrong holdings")
         to_drop_dates = to_drop["date"].values
@@ -575,15 +688,23 @@ class Portfolio:
 
     def get_pnl_timeseries(self) -> pd.DataFrame:
         """Calculate the pnl timeseries for the entire `Portfolio`. Returns a dataframe with date, total invested amount, current value, pnl and pnl percentage."""
+        # fetching the nav data is io bound, so it is done in parallel and once per scheme
+        scheme_codes = list(dict.fromkeys(x.scheme_code for x in self.holdings))
+        max_workers = min(16, max(len(scheme_codes), 1))
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            nav_data = dict(zip(scheme_codes, pool.map(fetch_nav_data, scheme_codes)))
+        self.logger.info(f"Nav data fetched for {len(scheme_codes)} schemes")
+
         pnls = []
         for holding in self.holdings:
-            pnl = holding.get_pnl_timeseries()
+            pnl = holding.get_pnl_timeseries(nav_data[holding.scheme_code])
             # take only the required columns
             pnl["scheme_code"] = holding.scheme_code
             pnls.append(pnl)
 
         pnl = pd.concat(pnls, ignore_index=True)
         self.pnl = pnl
+        self.scheme_indices = pnl.groupby("scheme_code", sort=False).indices
 
         pnl = pnl[["date", "total_invested", "current_value", "scheme_code"]]
         pnl = pnl.groupby("date").aggregate(
@@ -604,19 +725,16 @@ class Portfolio:
 
     @property
     def transaction_dates(self):
-        """Get the transaction dates for the entire `Portfolio`. Returns a dictionary with keys `purchase_dates` and `sell_dates`."""
-        transaction_dates = {"purchase_dates": [], "sell_dates": []}
-        for holding in self.holdings:
-            holding_purchase_dates = holding.transaction_dates["purchase_dates"]
-            holding_sell_dates = holding.transaction_dates["sell_dates"]
-            transaction_dates["purchase_dates"].extend(holding_purchase_dates)
-            transaction_dates["sell_dates"].extend(holding_sell_dates)
-
-        transaction_dates["purchase_dates"] = sorted(
-            list(set(transaction_dates["purchase_dates"]))
-        )
-        transaction_dates["sell_dates"] = sorted(
-            list(set(transaction_dates["sell_dates"]))
+        """Get the transaction dates for the entire `Portfolio`. Returns a dictionary with keys `purchase_dates` and `sell_dates` holding a `pd.DatetimeIndex` each."""
+        # merge the already sorted dates of each holding and drop the duplicates
+        purchase_dates = merge(
+            *[x.purchase_history.sorted_dates for x in self.holdings]
         )
-
-        return transaction_dates
+        sell_dates = merge(*[x.sell_history.sorted_dates for x in self.holdings])
+        # as a DatetimeIndex, the dates can be matched against datetime64 columns
+        return {
+            "purchase_dates": pd.DatetimeIndex(
+                [date for date, _ in groupby(purchase_dates)]
+            ),
+            "sell_dates": pd.DatetimeIndex([date for date, _ in groupby(sell_dates)]),
+        }
@@ -1,7 +1,11 @@
 from typing import List, Dict
+import atexit
 from collections import OrderedDict
+from functools import lru_cache
+from datetime import datetime
 import pandas as pd
 import numpy as np
+from pandas.api.types import is_datetime64_any_dtype
 from pymongo import MongoClient
 from urllib.parse import quote_plus
 import env as env
@@ -14,6 +18,7 @@ pio.templates.default = "plotly_dark"
 # set font
 pio.templates[pio.templates.default].layout["font"]["family"] = "Roboto"
 pio.templates[pio.templates.default].layout["font"]["size"] = 12
+# st.plotly_chart serializes through plotly.io.to_json, which uses orjson when it is installed
 
 
 from mutual_funds import get_simple_logger
@@ -25,11 +30,14 @@ class NoTransactions(Exception):
     pass
 
 
+# MongoClient is thread safe and pools its connections, so one client is shared
+@lru_cache(maxsize=1)
 def get_mongo_client():
-    string = f"mongodb+srv://{env.MONGO_USER}:{env.MONGO_PASSWORD}@{env.MONGO_HOST}/funds?retryWrites=true&w=majority"
-    string = string.replace(env.MONGO_USER, quote_plus(env.MONGO_USER))
-    string = string.replace(env.MONGO_PASSWORD, quote_plus(env.MONGO_PASSWORD))
+    user = quote_plus(env.MONGO_USER)
+    password = quote_plus(env.MONGO_PASSWORD)
+    string = f"mongodb+srv://{user}:{password}@{env.MONGO_HOST}/funds?retryWrites=true&w=majority"
     client = MongoClient(string)
+    atexit.register(client.close)
     return client
 
 
@@ -55,34 +63,41 @@ def save_config(config):
 def get_transactions(client, username):
     db = client[env.MONGO_DB]
     transactions = db[env.MONGO_TRANSACTIONS_COLLECTION]
-    transactions = transactions.find_one({"username": username})
+    transactions = transactions.find_one(
+        {"username": username}, {env.MONGO_TRANSACTIONS_COLLECTION: 1, "_id": 0}
+    )
     if not transactions:
         raise NoTransactions(f"No transactions found for {username}")
     return transactions[env.MONGO_TRANSACTIONS_COLLECTION]
 
 
-def create_mapping(as_df=False):
+@lru_cache(maxsize=1)
+def _fetch_mapping(hour):
+    """Fetches the isin to scheme code mapping. It rarely changes, so it is cached per `hour` (e.g. `2024-06-28 14`)"""
     client = get_mongo_client()
     db = client[env.MONGO_DB]
     mapping_c = db[env.MONGO_MAPPING_COLLECTION]
-    mapping = mapping_c.find_one()["isin_to_scheme_code"]
+    return mapping_c.find_one({}, {"isin_to_scheme_code": 1, "_id": 0})[
+        "isin_to_scheme_code"
+    ]
+
+
+def create_mapping(as_df=False):
+    mapping = _fetch_mapping(datetime.now().strftime("%Y-%m-%d %H"))
     if as_df:
         mapping = pd.DataFrame(mapping)
 
     return mapping
 
 
-def _one_transaction(transaction):
-    units = transaction["quantity"]
-    average_nav = transaction["price"]
-    date = transaction["trade_date"]
-    trade_type = transaction["trade_type"]
-    if trade_type == "buy":
-        date_column = "purchase_date"
-    else:
-        date_column = "sale_date"
-
-    return {"units": units, "average_nav": average_nav, date_column: date}
+def _transactions(df, date_column):
+    """Creates the transaction dicts of a tradebook by zipping its columns, without building a Series for each row"""
+    return [
+        {"units": units, "average_nav": average_nav, date_column: date}
+        for units, average_nav, date in zip(
+            df["quantity"].tolist(), df["price"].tolist(), df["trade_date"].tolist()
+        )
+    ]
 
 
 def convert_one_trade(df):
@@ -92,8 +107,8 @@ def convert_one_trade(df):
     buys = df[df["trade_type"] == "buy"]
     sells = df[df["trade_type"] == "sell"]
 
-    purchase_history = buys.apply(_one_transaction, axis=1).to_list()
-    sale_history = sells.apply(_one_transaction, axis=1).to_list()
+    purchase_history = _transactions(buys, "purchase_date")
+    sale_history = _transactions(sells, "sale_date")
     final_dict = {
         "scheme_code": code,
         "isin": isin,
@@ -123,11 +138,10 @@ def update_transactions(tradebook_file, username, debug=True):
         logger.error(m)
         raise ValueError(m)
 
-    codes = tradebook["scheme_code"].unique()
-    final_list = []
-    for code in codes:
-        df = tradebook[tradebook["scheme_code"] == code]
-        final_list.append(convert_one_trade(df))
+    # one pass over the tradebook, schemes stay in the order they first appear
+    final_list = [
+        convert_one_trade(df) for _, df in tradebook.groupby("scheme_code", sort=False)
+    ]
 
     final_list = {"username": username, env.MONGO_TRANSACTIONS_COLLECTION: final_list}
     logger.info("Final list created")
@@ -138,31 +152,23 @@ def update_transactions(tradebook_file, username, debug=True):
     db = client[env.MONGO_DB]
     collection_name = env.MONGO_TRANSACTIONS_COLLECTION
     collection = db[collection_name]
-    if collection.find_one({"username": username}) is None:
-        logger.info(f"Inserting transactions for user {username}")
-        # new user, add new item
-        collection.insert_one(final_list)
-    else:
-        logger.info(f"Updating transactions for user {username}")
-        collection.update_one({"username": username}, {"$set": final_list})
+    logger.info(f"Saving transactions for user {username}")
+    # upsert inserts the document for a new user and updates it otherwise
+    collection.update_one({"username": username}, {"$set": final_list}, upsert=True)
 
 
 def get_all_holdings(pnl_all):
     mapping = create_mapping()
+    # keep the first entry for each scheme code, like the linear search did
+    code_to_name = {}
+    for x in mapping:
+        code_to_name.setdefault(x["scheme_code"], x["short_name"] or x["symbol"])
     schemes = pnl_all["scheme_code"].unique().tolist()
-    names = []
-    for scheme in schemes:
-        matched = list(filter(lambda x: x["scheme_code"] == scheme, mapping))
-        if matched:
-            symbol = matched[0]["symbol"]
-            short_name = matched[0]["short_name"]
-            short_name = short_name or symbol
-            names.append(short_name)
-        else:
-            names.append("Unknown")
-
-    names_scheme_mapping = OrderedDict(zip(schemes, names))
-    schemes_names_mapping = OrderedDict(zip(names, schemes))
+    names = [code_to_name.get(scheme, "Unknown") for scheme in schemes]
+
+    # plain dicts keep insertion order, so the holdings stay in the order of pnl_all
+    names_scheme_mapping = dict(zip(schemes, names))
+    schemes_names_mapping = dict(zip(names, schemes))
     return names_scheme_mapping, schemes_names_mapping
 
 
@@ -170,51 +176,56 @@ def format_numbers(df, int_columns, float_round_digits=2):
     number_columns = df.select_dtypes(include=[np.number]).columns
     logger.debug(f"Number columns: {number_columns}")
     logger.debug(f"Int columns: {int_columns}")
-    for column in number_columns:
-        if column in int_columns:
-            try:
-                df[column] = df[column].astype(int)
-            except ValueError:
-                logger.error(f"Could not convert {column} to int. Dropping Column")
-                df.drop(column, axis=1, inplace=True)
-        else:
-            df[column] = df[column].round(float_round_digits)
+    is_int = number_columns.isin(int_columns)
+    int_columns, float_columns = number_columns[is_int], number_columns[~is_int]
+    # missing or infinite values can not be converted to int
+    finite = np.isfinite(df[int_columns].to_numpy(dtype=float)).all(axis=0)
+    for column in int_columns[~finite]:
+        logger.error(f"Could not convert {column} to int. Dropping Column")
+    df = df.drop(columns=int_columns[~finite])
+    int_columns = int_columns[finite]
+    # cast and round all the columns at once instead of one by one
+    df[int_columns] = df[int_columns].astype(int)
+    df[float_columns] = df[float_columns].round(float_round_digits)
     return df
 
 
 def create_scheme_level_absolute_pnl_summary(pnl_all, names_scheme_mapping, num_days=3):
-    pnl_all["date"] = pd.to_datetime(pnl_all["date"])
+    if not is_datetime64_any_dtype(pnl_all["date"]):
+        pnl_all = pnl_all.assign(date=pd.to_datetime(pnl_all["date"]))
     dates = pnl_all["date"].unique()
-    dates = sorted(dates)
-    dates_to_take = dates[-num_days:]
-
-    pnl_summary = pnl_all[pnl_all["date"].isin(dates_to_take)]
-    pnl_summary["scheme_name"] = pnl_summary["scheme_code"].replace(
-        names_scheme_mapping
+    # only the last `num_days` dates are needed, partition instead of sorting them all
+    if num_days < len(dates):
+        dates = np.partition(dates, -num_days)[-num_days:]
+    dates_to_take = np.sort(dates)[-num_days:]
+
+    # take only the needed columns, the rename gives a new frame so nothing is set on a view
+    pnl_summary = pnl_all.loc[
+        pnl_all["date"].isin(dates_to_take),
+        ["scheme_code", "date", "pnl", "pnl_percentage"],
+    ].rename(columns={"pnl_percentage": "pnl%"})
+    # pivot on the scheme code, different schemes can share a name and must not be merged
+    # unstack fills the missing (scheme, date) cells directly instead of going through NaN
+    pnl_summary_pivot = pnl_summary.set_index(["scheme_code", "date"]).unstack(
+        "date", fill_value=0
     )
-    pnl_summary = pnl_summary.sort_index(ascending=False)
-    pnl_summary.rename(columns={"pnl_percentage": "pnl%"}, inplace=True)
-    pnl_summary_pivot = (
-        pnl_summary.pivot(index="scheme_name", columns="date", values=["pnl", "pnl%"])
-        .fillna(0)
-        .reset_index()
+    # the names are looked up once per scheme, sorting by them keeps the order of the pivot
+    pnl_summary_pivot.index = pnl_summary_pivot.index.map(
+        lambda scheme_code: names_scheme_mapping.get(scheme_code, "Unknown")
     )
-    pnl_summary_pivot.columns = ["scheme"] + [
-        f"{col[0]}_{col[1].date()}" for col in pnl_summary_pivot.columns[1:]
+    pnl_summary_pivot = pnl_summary_pivot.sort_index(kind="stable")
+    # latest date first, keeping all the pnl columns before the pnl% ones
+    pnl_summary_pivot = pnl_summary_pivot.reindex(
+        columns=dates_to_take[::-1], level="date"
+    )
+    pnl_summary_pivot.columns = [
+        f"{metric}_{date.date()}".title() for metric, date in pnl_summary_pivot.columns
     ]
-    pnl_summary_pivot = pnl_summary_pivot.T.sort_index(ascending=False).T
+    pnl_summary_pivot.index.name = "Scheme"
     pnl_summary_pivot = pnl_summary_pivot.sort_values(
-        by=pnl_summary_pivot.columns[1], ascending=False
+        by=pnl_summary_pivot.columns[0], ascending=False
     )
 
-    og_columns = pnl_summary_pivot.columns
-    new_columns = [col.title() for col in og_columns]
-    pnl_summary_pivot.columns = new_columns
-    pnl_summary_pivot.set_index("Scheme", inplace=True)
-
-    for col in pnl_summary_pivot.columns:
-        pnl_summary_pivot[col] = pnl_summary_pivot[col].astype(float)
-
     int_columns = [col for col in pnl_summary_pivot.columns if "Pnl_" in col]
     pnl_summary_pivot = format_numbers(
         pnl_summary_pivot, int_columns, float_round_digits=4
@@ -230,14 +241,22 @@ def create_dates_and_filtered_df(pnl, extra_deltas=None, extra_names=None):
     deltas = [1, 2, 3, 7, 15, 30]
     if extra_deltas:
         deltas.extend(extra_deltas)
-    dates_to_use = [last_date - pd.Timedelta(days=i) for i in deltas]
-    dates_to_use = [last_date] + dates_to_use + [first_date]
+    # T itself, then every delta before it and finally the first date
+    dates_to_use = (last_date - pd.to_timedelta([0] + deltas, unit="D")).append(
+        pd.DatetimeIndex([first_date])
+    )
 
-    dates_matched = _match_nearest_date(
-        dates_to_use, pnl["date"].tolist()[::-1]
-    )  # date should be in descending order
+    # the pnl timeseries comes sorted by date, only sort when it is not
+    is_sorted = pnl["date"].is_monotonic_increasing
+    all_dates = pd.DatetimeIndex(pnl["date"].unique())
+    if not is_sorted:
+        all_dates = all_dates.sort_values()
+    dates_matched = _match_nearest_date(dates_to_use, all_dates)
     summary_df = pnl[pnl["date"].isin(dates_matched)]
-    summary_df = summary_df.sort_values("date", ascending=False)
+    if is_sorted:
+        summary_df = summary_df.iloc[::-1]
+    else:
+        summary_df = summary_df.sort_values("date", ascending=False)
     date_names = [
         "T",
         "T-1",
@@ -268,48 +287,42 @@ def create_scheme_level_relative_pnl_summary(
         pnl, extra_deltas, extra_names
     )
 
-    total_investments = (
-        summary_df.groupby(["scheme_code", "date"])[["total_invested"]]
+    pnl_all_ = (
+        summary_df.groupby(["scheme_code", "date"])[["pnl", "total_invested"]]
         .sum()
         .reset_index()
     )
-    total_investments = total_investments.drop_duplicates(
-        subset=["scheme_code"], keep="last"
+    # dates are sorted within each scheme, so the last row holds its latest values
+    latest = pnl_all_.groupby("scheme_code")[["pnl", "total_invested"]].transform(
+        "last"
     )
-    total_investments.drop("date", axis=1, inplace=True)
-    pnl_all_ = summary_df.groupby(["scheme_code", "date"])[["pnl"]].sum().reset_index()
-    current_pnl = pnl_all_.drop_duplicates(subset=["scheme_code"], keep="last")
-
-    current_pnl = current_pnl.rename(columns={"pnl": "current_pnl"})
-    current_pnl = current_pnl[["scheme_code", "current_pnl"]]
-    pnl_all_ = pd.merge(pnl_all_, current_pnl, on=["scheme_code"], how="left")
-    pnl_all_ = pd.merge(pnl_all_, total_investments, on=["scheme_code"], how="left")
+    pnl_all_["current_pnl"] = latest["pnl"]
+    pnl_all_["total_invested"] = latest["total_invested"]
     pnl_all_["change_in_pnl"] = pnl_all_["current_pnl"] - pnl_all_["pnl"]
-    pnl_all_["change_in_pnl%"] = (
-        pnl_all_["change_in_pnl"] / pnl_all_["total_invested"]
-    ) * 100
-    pnl_all_["change_in_pnl%"].replace(np.inf, 100, inplace=True),
-    pnl_all_["change_in_pnl%"].replace(-np.inf, -100, inplace=True)
+    # a change on no investment is capped at +/-100%, missing values stay NaN
+    pnl_all_["change_in_pnl%"] = np.nan_to_num(
+        (pnl_all_["change_in_pnl"] / pnl_all_["total_invested"]).to_numpy() * 100,
+        nan=np.nan,
+        posinf=100,
+        neginf=-100,
+    )
 
+    # rows are already unique per (scheme, date), so unstack directly instead of pivot
     final_df = (
-        pnl_all_.pivot(
-            columns="scheme_code",
-            index="date",
-            values=["change_in_pnl%", "change_in_pnl"],
-        )
+        pnl_all_.set_index(["date", "scheme_code"])[["change_in_pnl%", "change_in_pnl"]]
+        .unstack("scheme_code")
         .bfill()
         .sort_index(ascending=False)
     )
-    final_df.columns = final_df.columns.to_flat_index()
-    columns = [f"{col[0]}_{names_scheme_mapping[col[1]]}" for col in final_df.columns]
-    final_df.columns = columns
-    final_df = final_df.reset_index()
-    final_df.rename(columns={"date": "Date"}, inplace=True)
-    final_df["Date"] = final_df["Date"].dt.strftime("%Y-%m-%d")
+    final_df.columns = [
+        f"{metric}_{names_scheme_mapping[scheme_code]}"
+        for metric, scheme_code in final_df.columns
+    ]
+    # the dates become the first column, the index holds the time period names
+    final_df.insert(0, "Date", final_df.index.strftime("%Y-%m-%d"))
     final_df.index = date_names
     int_columns = [col for col in final_df.columns if "change_in_pnl_" in col]
     final_df = format_numbers(final_df, int_columns, float_round_digits=4)
-    final_df = final_df.rename(columns={"index": "date"})
     final_df.index.name = "Date"
     # remove the first row, which is the current date
     final_df = final_df.iloc[1:]
@@ -323,6 +336,98 @@ label_map = {
     "current_value": "Current Value",
 }
 
+# marker styles for the transaction dots, plotly copies them into each trace
+PURCHASE_MARKER = dict(color="green", size=10)
+SELL_MARKER = dict(color="red", size=10)
+PURCHASE_MARKER_SMALL = dict(color="green", size=8)
+SELL_MARKER_SMALL = dict(color="red", size=8)
+
+# maximum number of points sent to the browser for a single line trace
+MAX_PLOT_POINTS = 2000
+
+# WebGL only pays off for larger plots and browsers limit the number of WebGL contexts
+WEBGL_MIN_POINTS = 1000
+
+
+def scatter_trace(num_points):
+    """Returns `go.Scattergl` for plots with more than `WEBGL_MIN_POINTS` points, `go.Scatter` otherwise"""
+    return go.Scattergl if num_points > WEBGL_MIN_POINTS else go.Scatter
+
+
+# for long series, the min and max of `MINMAX_RATIO * n_out` buckets are kept before running LTTB
+MINMAX_RATIO = 4
+
+
+def _minmax_indices(y, n_out):
+    """Returns the sorted indices of the points to keep so that at most `n_out` points remain. The first and last points are always kept and the series in between is split into equal sized buckets from which the minimum and the maximum are kept."""
+    n = len(y)
+    if n <= n_out:
+        return np.arange(n)
+
+    inner = np.asarray(y[1:-1], dtype=float)
+    bucket_size = int(np.ceil(len(inner) / ((n_out - 2) // 2)))
+    n_buckets = int(np.ceil(len(inner) / bucket_size))
+    padded = np.full(n_buckets * bucket_size, np.nan)
+    padded[: len(inner)] = inner
+    padded = padded.reshape(n_buckets, bucket_size)
+    # nan is used for padding, make sure it is never picked
+    min_idx = np.where(np.isnan(padded), np.inf, padded).argmin(axis=1)
+    max_idx = np.where(np.isnan(padded), -np.inf, padded).argmax(axis=1)
+    offsets = np.arange(n_buckets) * bucket_size + 1
+    idx = np.concatenate([[0], offsets + min_idx, offsets + max_idx, [n - 1]])
+    return np.unique(idx)
+
+
+def _lttb_indices(x, y, n_out):
+    """Largest Triangle Three Buckets. Returns the sorted indices of the `n_out` points that best preserve the visual shape of the series. `x` must be numeric and sorted."""
+    n = len(y)
+    if n <= n_out:
+        return np.arange(n)
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    # the first and last points are always kept, rest is split in `n_out - 2` buckets
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    # the average of every bucket is computed at once, the last one only holds the last point
+    sizes = np.diff(edges, append=n)
+    avg_x = (np.add.reduceat(x, edges) / sizes)[1:].tolist()
+    avg_y = (np.add.reduceat(y, edges) / sizes)[1:].tolist()
+    # buckets only hold a few points after the minmax preselection, so the sequential
+    # part runs on python floats instead of paying the numpy call overhead per bucket
+    xs = x.tolist()
+    ys = y.tolist()
+    edges = edges.tolist()
+    idx = np.empty(n_out, dtype=np.int64)
+    idx[0] = 0
+    idx[-1] = n - 1
+    a = 0
+    for i in range(n_out - 2):
+        x_a, y_a = xs[a], ys[a]
+        dx = x_a - avg_x[i]
+        dy = avg_y[i] - y_a
+        max_area = -1.0
+        a = edges[i]
+        for j in range(edges[i], edges[i + 1]):
+            area = abs(dx * (ys[j] - y_a) - (x_a - xs[j]) * dy)
+            if area > max_area:
+                max_area = area
+                a = j
+        idx[i + 1] = a
+    return idx
+
+
+def downsample(x, y, n_out=MAX_PLOT_POINTS):
+    """Downsample a line trace to at most `n_out` points using MinMaxLTTB so that only the visually relevant points are sent to the browser. Returns the downsampled x and y as numpy arrays."""
+    x = np.asarray(x)
+    y = np.asarray(y)
+    if len(y) <= n_out:
+        return x, y
+
+    x_numeric = x.view("i8") if np.issubdtype(x.dtype, np.datetime64) else x
+    idx = _minmax_indices(y, MINMAX_RATIO * n_out)
+    idx = idx[_lttb_indices(x_numeric[idx], y[idx], n_out)]
+    return x[idx], y[idx]
+
 
 def plot_single_column_with_date(
     df: pd.DataFrame,
@@ -356,55 +461,50 @@ def plot_single_column_with_date(
     """
     yaxis_label = label_map[column_name]
     if resample_frequency:
-        df = df.copy()
-        df = df.set_index("date")
-        df = df.asfreq(resample_frequency, method="ffill")
-        df["date"] = df.index
-
-    # create a plotly figure
-    fig = go.Figure()
-    # add a line to the plot
-    fig.add_trace(
-        go.Scatter(x=df["date"], y=df[column_name], mode="lines", name=yaxis_label)
-    )
-    # set the title
-    fig.update_layout(title=title)
-    # set the x-axis label
-    fig.update_xaxes(title_text="Date")
-    # set the y-axis label
-    fig.update_yaxes(title_text=yaxis_label)
-    if not add_transactions or resample_frequency:
-        return fig
-
-    purchase_dates = transaction_dates["purchase_dates"]
-    sell_dates = transaction_dates["sell_dates"]
-    purchase_dates_value = df[df["date"].isin(purchase_dates)][
-        column_name
-    ].drop_duplicates()
-    sell_dates_value = df[df["date"].isin(sell_dates)][column_name].drop_duplicates()
-
-    # add the purchase_dates as green dots
-    fig.add_trace(
-        go.Scatter(
-            x=purchase_dates,
-            y=purchase_dates_value,
-            mode="markers",
-            marker=dict(color="green", size=10),
-            name="Purchase",
+        # only the plotted column is resampled, "date" is already datetime64[ns]
+        df = (
+            df[["date", column_name]]
+            .set_index("date")
+            .asfreq(resample_frequency, method="ffill")
+            .reset_index()
         )
-    )
 
-    # add the sell_dates as red dots
-    fig.add_trace(
-        go.Scatter(
-            x=sell_dates,
-            y=sell_dates_value,
-            mode="markers",
-            marker=dict(color="red", size=10),
-            name="Sell",
-        )
+    # add a line to the plot
+    x, y = downsample(df["date"], df[column_name])
+    scatter = scatter_trace(len(x))
+    traces = [scatter(x=x, y=y, mode="lines", name=yaxis_label)]
+    if add_transactions and not resample_frequency:
+        purchase_dates = transaction_dates["purchase_dates"]
+        sell_dates = transaction_dates["sell_dates"]
+        # as datetime64 the membership test runs on int64 instead of python objects
+        purchase_mask = df["date"].isin(pd.DatetimeIndex(purchase_dates))
+        sell_mask = df["date"].isin(pd.DatetimeIndex(sell_dates))
+        purchase_dates_value = df.loc[purchase_mask, column_name].drop_duplicates()
+        sell_dates_value = df.loc[sell_mask, column_name].drop_duplicates()
+        traces += [
+            # the purchase_dates as green dots
+            go.Scatter(
+                x=purchase_dates,
+                y=purchase_dates_value,
+                mode="markers",
+                marker=PURCHASE_MARKER,
+                name="Purchase",
+            ),
+            # the sell_dates as red dots
+            go.Scatter(
+                x=sell_dates,
+                y=sell_dates_value,
+                mode="markers",
+                marker=SELL_MARKER,
+                name="Sell",
+            ),
+        ]
+
+    # create a plotly figure with all the traces and the title and axis labels at once
+    fig = go.Figure(
+        data=traces,
+        layout=dict(title=title, xaxis_title="Date", yaxis_title=yaxis_label),
     )
-
     return fig
 
 
@@ -445,86 +545,73 @@ def plot_two_columns_with_date(
     yaxis_label2 = label_map[column_name2]
 
     if resample_frequency:
-        df = df.copy()
-        df = df.set_index("date")
-        df = df.asfreq(resample_frequency, method="ffill")
-        df["date"] = df.index
-    # create a plotly figure
-    fig = make_subplots(specs=[[{"secondary_y": True}]])
-    # add a line to the plot
-    fig.add_trace(
-        go.Scatter(x=df["date"], y=df[column_name1], mode="lines", name=yaxis_label1),
-        secondary_y=False,
-    )
-    fig.add_trace(
-        go.Scatter(x=df["date"], y=df[column_name2], mode="lines", name=yaxis_label2),
-        secondary_y=True,
-    )
-    # set the title
-    fig.update_layout(title=title)
-    # set the x-axis label
-    fig.update_xaxes(title_text="Date")
-    # set the y-axis label
-    fig.update_yaxes(title_text=yaxis_label1, secondary_y=False)
-    fig.update_yaxes(title_text=yaxis_label2, secondary_y=True)
-    if not add_transactions:
-        return fig
-
-    purchase_dates = transaction_dates["purchase_dates"]
-    sell_dates = transaction_dates["sell_dates"]
-    purchase_dates_value1 = df[df["date"].isin(purchase_dates)][
-        column_name1
-    ].drop_duplicates()
-    purchase_dates_value2 = df[df["date"].isin(purchase_dates)][
-        column_name2
-    ].drop_duplicates()
-    sell_dates_value1 = df[df["date"].isin(sell_dates)][column_name1].drop_duplicates()
-    sell_dates_value2 = df[df["date"].isin(sell_dates)][column_name2].drop_duplicates()
-
-    # add the purchase_dates as green dots
-    fig.add_trace(
-        go.Scatter(
-            x=purchase_dates,
-            y=purchase_dates_value1,
-            mode="markers",
-            marker=dict(color="green", size=8),
-            name="Purchase",
+        # only the plotted columns are resampled, "date" is already datetime64[ns]
+        df = (
+            df[["date", column_name1, column_name2]]
+            .set_index("date")
+            .asfreq(resample_frequency, method="ffill")
+            .reset_index()
         )
-    )
-    fig.add_trace(
-        go.Scatter(
-            x=purchase_dates,
-            y=purchase_dates_value2,
-            mode="markers",
-            marker=dict(color="green", size=8),
-            name="Purchase",
-        ),
-        secondary_y=True,
-    )
-
-    # add the sell_dates as red dots
-    fig.add_trace(
-        go.Scatter(
-            x=sell_dates,
-            y=sell_dates_value1,
-            mode="markers",
-            marker=dict(color="red", size=8),
-            name="Sell",
-        )
-    )
-    fig.add_trace(
-        go.Scatter(
-            x=sell_dates,
-            y=sell_dates_value2,
-            mode="markers",
-            marker=dict(color="red", size=8),
-            name="Sell",
-        ),
-        secondary_y=True,
+    # add a line to the plot
+    x1, y1 = downsample(df["date"], df[column_name1])
+    x2, y2 = downsample(df["date"], df[column_name2])
+    scatter = scatter_trace(len(x1) + len(x2))
+    traces = [
+        scatter(x=x1, y=y1, mode="lines", name=yaxis_label1),
+        scatter(x=x2, y=y2, mode="lines", name=yaxis_label2),
+    ]
+    secondary_ys = [False, True]
+    if add_transactions:
+        purchase_dates = transaction_dates["purchase_dates"]
+        sell_dates = transaction_dates["sell_dates"]
+        # find the transaction rows once and reuse them for both columns
+        purchase_mask = df["date"].isin(pd.DatetimeIndex(purchase_dates))
+        sell_mask = df["date"].isin(pd.DatetimeIndex(sell_dates))
+        purchase_rows = df.loc[purchase_mask, [column_name1, column_name2]]
+        sell_rows = df.loc[sell_mask, [column_name1, column_name2]]
+        for column_name, secondary_y in [(column_name1, False), (column_name2, True)]:
+            # the purchase_dates as green dots
+            traces.append(
+                go.Scatter(
+                    x=purchase_dates,
+                    y=purchase_rows[column_name].drop_duplicates(),
+                    mode="markers",
+                    marker=PURCHASE_MARKER_SMALL,
+                    name="Purchase",
+                )
+            )
+            secondary_ys.append(secondary_y)
+        for column_name, secondary_y in [(column_name1, False), (column_name2, True)]:
+            # the sell_dates as red dots
+            traces.append(
+                go.Scatter(
+                    x=sell_dates,
+                    y=sell_rows[column_name].drop_duplicates(),
+                    mode="markers",
+                    marker=SELL_MARKER_SMALL,
+                    name="Sell",
+                )
+            )
+            secondary_ys.append(secondary_y)
+
+    # create a plotly figure with all the traces at once
+    fig = make_subplots(specs=[[{"secondary_y": True}]])
+    fig.add_traces(traces, secondary_ys=secondary_ys)
+    # set the title and the axis labels, yaxis2 is the secondary y-axis
+    fig.update_layout(
+        title=title,
+        xaxis_title="Date",
+        yaxis_title=yaxis_label1,
+        yaxis2_title=yaxis_label2,
     )
     return fig
 
 
+def _title(title, holding_name=None):
+    """Appends the holding name to a plot title, if there is one"""
+    return f"{title} for {holding_name}" if holding_name else title
+
+
 def plot_pnl(
     df,
     transaction_dates,
@@ -532,13 +619,12 @@ def plot_pnl(
     resample_frequency=None,
 ):
     """Plots the PnL for a holding/portfolio"""
-    if holding_name:
-        title = f"PnL for {holding_name}"
-    else:
-        title = "PnL"
-
     return plot_single_column_with_date(
-        df, transaction_dates, "pnl", title, resample_frequency=resample_frequency
+        df,
+        transaction_dates,
+        "pnl",
+        _title("PnL", holding_name),
+        resample_frequency=resample_frequency,
     )
 
 
@@ -549,16 +635,11 @@ def plot_pnl_percentage(
     resample_frequency=None,
 ):
     """Plots the PnL % for a holding/portfolio"""
-    if holding_name:
-        title = f"PnL % for {holding_name}"
-    else:
-        title = "PnL %"
-
     return plot_single_column_with_date(
         df,
         transaction_dates,
         "pnl_percentage",
-        title,
+        _title("PnL %", holding_name),
         resample_frequency=resample_frequency,
     )
 
@@ -570,16 +651,11 @@ def plot_total_investment(
     resample_frequency=None,
 ):
     """Plots the total investment for a holding/portfolio"""
-    if holding_name:
-        title = f"Total Investment for {holding_name}"
-    else:
-        title = "Total Investment"
-
     return plot_single_column_with_date(
         df,
         transaction_dates,
         "total_invested",
-        title,
+        _title("Total Investment", holding_name),
         resample_frequency=resample_frequency,
     )
 
@@ -591,16 +667,11 @@ def plot_current_value(
     resample_frequency=None,
 ):
     """Plots the current value for a holding/portfolio"""
-    if holding_name:
-        title = f"Current Value for {holding_name}"
-    else:
-        title = "Current Value"
-
     return plot_single_column_with_date(
         df,
         transaction_dates,
         "current_value",
-        title,
+        _title("Current Value", holding_name),
         resample_frequency=resample_frequency,
     )
 
@@ -612,17 +683,12 @@ def plot_total_investment_and_current_value(
     resample_frequency=None,
 ):
     """Plots the total investment and current value for a holding/portfolio on the same plot"""
-    if holding_name:
-        title = f"Total Investment and Current Value for {holding_name}"
-    else:
-        title = "Total Investment and Current Value"
-
     return plot_two_columns_with_date(
         df,
         transaction_dates,
         "total_invested",
         "current_value",
-        title,
+        _title("Total Investment and Current Value", holding_name),
         resample_frequency=resample_frequency,
     )
 
@@ -634,28 +700,27 @@ def plot_pnl_and_pnl_percentage(
     resample_frequency=None,
 ):
     """Plots the PnL and PnL % for a holding/portfolio on the same plot"""
-    if holding_name:
-        title = f"PnL and PnL % for {holding_name}"
-    else:
-        title = "PnL and PnL %"
-
     return plot_two_columns_with_date(
         df,
         transaction_dates,
         "pnl",
         "pnl_percentage",
-        title,
+        _title("PnL and PnL %", holding_name),
         resample_frequency=resample_frequency,
     )
 
 
 def _match_nearest_date(dates_to_match, all_dates):
+    """For each date in `dates_to_match`, finds the latest date in `all_dates` (sorted, ascending) on or before it which has not been matched already"""
+    positions = all_dates.searchsorted(dates_to_match, side="right") - 1
     dates_matched = []
-    for date in dates_to_match:
-        for d in all_dates:
-            if d <= date and d not in dates_matched:
-                dates_matched.append(d)
-                break
+    taken = set()
+    for position in positions.tolist():
+        while position in taken:
+            position -= 1
+        if position >= 0:
+            taken.add(position)
+            dates_matched.append(all_dates[position])
     return dates_matched
 
 
@@ -664,42 +729,33 @@ def create_summary(pnl, extra_deltas=None, extra_names=None):
         pnl, extra_deltas=extra_deltas, extra_names=extra_names
     )
 
-    total_investments = summary_df["total_invested"].values.tolist()
-    current_values = summary_df["current_value"].values.tolist()
-    pnl_ = summary_df["pnl"].values
-    final_pnl = pnl_[0]
-    pnl_change = final_pnl - pnl_
-
-    summary_dict = {
-        "date": date_names,
-        "date (og)": summary_df["date"].values,
-        "total_investments": total_investments,
-        "current_values": current_values,
-        "pnl_change_relative": pnl_change,
-    }
-    summary_df = pd.DataFrame(summary_dict)
-    summary_df["pnl"] = summary_df["current_values"] - summary_df["total_investments"]
-    summary_df["pnl_percentage"] = (
-        summary_df["pnl"] / summary_df["total_investments"]
-    ) * 100
-    summary_df["pnl_change_relative_percentage"] = (
-        summary_df["pnl_change_relative"] / summary_df["total_investments"].iloc[0]
-    ) * 100
-
-    int_columns = ["total_investments", "current_values", "pnl", "pnl_change_relative"]
-    summary_df[int_columns] = summary_df[int_columns].astype(int)
-    float_columns = ["pnl_percentage", "pnl_change_relative_percentage"]
-    summary_df[float_columns] = summary_df[float_columns].round(2)
-    rename_map = {
-        "date": "Time Period (Trading Days)",
-        "date (og)": "Date",
-        "total_investments": "Total Investment",
-        "current_values": "Current Value",
-        "pnl": "PnL",
-        "pnl_percentage": "PnL %",
-        "pnl_change_relative": "PnL Change",
-        "pnl_change_relative_percentage": "PnL Change %",
-    }
-    summary_df = summary_df.rename(columns=rename_map)
-    summary_df["Date"] = summary_df["Date"].dt.strftime("%Y-%m-%d")
+    total_investments = summary_df["total_invested"].to_numpy(dtype=float)
+    current_values = summary_df["current_value"].to_numpy(dtype=float)
+    pnl_ = summary_df["pnl"].to_numpy(dtype=float)
+    pnl_change = pnl_[0] - pnl_
+    pnl_ = current_values - total_investments
+    # no investment means no pnl, avoid dividing by zero
+    pnl_percentage = (
+        np.divide(
+            pnl_,
+            total_investments,
+            out=np.zeros(len(pnl_)),
+            where=total_investments != 0,
+        )
+        * 100
+    )
+    pnl_change_percentage = (pnl_change / total_investments[0]) * 100
+
+    summary_df = pd.DataFrame(
+        {
+            "Time Period (Trading Days)": date_names,
+            "Date": summary_df["date"].dt.strftime("%Y-%m-%d").to_numpy(),
+            "Total Investment": total_investments.astype(int),
+            "Current Value": current_values.astype(int),
+            "PnL Change": pnl_change.astype(int),
+            "PnL": pnl_.astype(int),
+            "PnL %": pnl_percentage.round(2),
+            "PnL Change %": pnl_change_percentage.round(2),
+        }
+    )
     return summary_df